@@ -1,15 +1,207 @@
-import json
-import requests
-import sseclient
+import asyncio
+import hashlib
+import httpx
+import itertools
+import logging
+import orjson
 import os
+import re
+import secrets
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
 from dotenv import load_dotenv
-from typing import Dict, List, Optional, Any, Union
+from typing import AsyncIterator, Dict, List, Optional, Any, Tuple, Union
 from autogen import ConversableAgent, LLMConfig
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# RE2 guarantees linear-time matching for the keyword router when installed
+try:
+    import re2 as _keyword_re
+except ImportError:
+    _keyword_re = re
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+class A2AError(Exception):
+    """A specialized agent could not answer a task"""
+
+AGENT_CARD_TTL = 300
+AGENT_CARD_CACHE_DIR = Path.home() / ".cache" / "a2a"
+RESPONSE_CACHE_TTL = 3600
+
+# autogen's generate_reply blocks, so it runs here instead of on the Streamlit thread
+executor = ThreadPoolExecutor(max_workers=8)
+
+AGENT_NAMES = {"sql": "SQL writer agent", "rag": "RAG agent"}
+
+# 'both' marks an ambiguous query that is fanned out to the SQL and RAG agents
+AGENT_TYPES = ("sql", "rag", "nothing", "both")
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+# Unambiguous keywords route without asking the LLM; inline (?i) works for both re and re2
+_SQL_PAT = _keyword_re.compile(r"(?i)\b(sales|customers?|revenue|order|sql|select|top \d+)\b")
+_RAG_PAT = _keyword_re.compile(r"(?i)\b(pinecone|index|upsert|embedding|vector db|documentation)\b")
+
+
+def _classify(query: str) -> Optional[str]:
+    """Route by keyword when exactly one specialized agent's keywords match"""
+    sql = _SQL_PAT.search(query) is not None
+    rag = _RAG_PAT.search(query) is not None
+    if sql != rag:
+        return "sql" if sql else "rag"
+    return None
+
+
+def _normalize(query: str) -> str:
+    """Normalize a query into a cache key (lowercased, punctuation stripped, whitespace collapsed)"""
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", query.lower())).strip()
+
+
+def _response_key(query: str) -> str:
+    """Normalize a query for the response cache (lowercased, whitespace collapsed)
+    
+    Unlike _normalize, punctuation is kept: '> 1000' and '< 1000' must not share an answer.
+    """
+    return _WHITESPACE.sub(" ", query.lower()).strip()
+
+
+class RouteCache:
+    """LRU cache of routing decisions with an optional semantic lookup tier"""
+    
+    def __init__(self, capacity: int = 1024, semantic: bool = False, threshold: float = 0.92):
+        """Initialize the route cache
+        
+        Args:
+            capacity: Maximum number of cached decisions
+            semantic: Also match near-duplicate queries by embedding similarity
+            threshold: Minimum cosine similarity for a semantic hit
+        """
+        self.capacity = capacity
+        self.threshold = threshold
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._embeddings: Dict[str, Any] = {}
+        # Shared by every Streamlit session in the process
+        self._lock = threading.Lock()
+        self._model = None
+        if semantic:
+            try:
+                from sentence_transformers import SentenceTransformer
+                self._model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+            except ImportError:
+                logger.warning("sentence-transformers not installed, semantic route cache disabled")
+    
+    async def embed(self, key: str) -> Any:
+        """Embed a normalized query on the shared thread pool, or None without the semantic tier"""
+        if self._model is None:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, lambda: self._model.encode(key, normalize_embeddings=True))
+    
+    def get(self, key: str, embedding: Any = None) -> Optional[str]:
+        """Return the cached decision for a normalized query, if any
+        
+        Args:
+            key: Normalized query
+            embedding: Embedding of the query from embed(); enables the semantic lookup
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            
+            if embedding is None or not self._embeddings:
+                return None
+            
+            # Embeddings are unit length, so the dot product is the cosine similarity
+            best_key, best_score = None, self.threshold
+            for cached_key, cached_embedding in self._embeddings.items():
+                score = float(embedding @ cached_embedding)
+                if score >= best_score:
+                    best_key, best_score = cached_key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key]
+    
+    def put(self, key: str, agent_type: str, embedding: Any = None) -> None:
+        """Store a decision, evicting the least recently used one on overflow"""
+        with self._lock:
+            self._entries[key] = agent_type
+            self._entries.move_to_end(key)
+            if embedding is not None:
+                self._embeddings[key] = embedding
+            while len(self._entries) > self.capacity:
+                evicted, _ = self._entries.popitem(last=False)
+                self._embeddings.pop(evicted, None)
+
+class ResponseCache:
+    """Redis cache of complete specialized agent responses"""
+    
+    def __init__(self, redis_url: Optional[str] = None, ttl: int = RESPONSE_CACHE_TTL):
+        """Initialize the response cache
+        
+        Args:
+            redis_url: Redis connection URL; the cache is disabled when unset
+            ttl: Expiry of cached responses in seconds
+        """
+        self.ttl = ttl
+        self.redis_url = redis_url
+        if redis_url and aioredis is None:
+            logger.warning("redis not installed, response cache disabled")
+            self.redis_url = None
+        # Created on first use and kept open, like the HTTP clients
+        self._client: Any = None
+    
+    @property
+    def client(self) -> Any:
+        """Pooled redis client, or None when the cache is disabled"""
+        if not self.redis_url:
+            return None
+        if self._client is None:
+            self._client = aioredis.Redis.from_url(self.redis_url, decode_responses=True)
+        return self._client
+    
+    @staticmethod
+    def key(agent_type: str, query: str) -> str:
+        return f"a2a:{agent_type}:{hashlib.sha256(_response_key(query).encode()).hexdigest()}"
+    
+    async def get(self, agent_type: str, query: str) -> Optional[str]:
+        """Return the cached response of an agent for a query, if any"""
+        client = self.client
+        if client is None:
+            return None
+        try:
+            return await client.get(self.key(agent_type, query))
+        except Exception as e:
+            logger.error("Error reading response cache: %s", e)
+            return None
+    
+    async def set(self, agent_type: str, query: str, content: str) -> None:
+        """Cache the response of an agent for a query"""
+        client = self.client
+        if client is None or not content:
+            return
+        try:
+            await client.set(self.key(agent_type, query), content, ex=self.ttl)
+        except Exception as e:
+            logger.error("Error writing response cache: %s", e)
+
+
 class A2AClient:
     """Client for interacting with A2A protocol agents"""
     
@@ -22,98 +214,309 @@ class A2AClient:
         self.agent_url = agent_url.rstrip('/')
         self.session_id = str(uuid.uuid4())
         
-    def discover_agent(self) -> Dict:
+        # Task ids share one random prefix per client; the counter keeps them unique
+        self._task_prefix = secrets.token_hex(4)
+        self._task_counter = itertools.count()
+        
+        # Pooled HTTP/2 client, created on first use and kept for the life of the
+        # process; all calls must run on the same long-lived event loop
+        self._client: Optional[httpx.AsyncClient] = None
+        
+        # JSON-RPC envelopes with the fixed parts pre-serialized; only the request
+        # id, task id and JSON-encoded session id and message text are spliced in
+        self._send_tpl = self._envelope(b"tasks/send")
+        self._subscribe_tpl = self._envelope(b"tasks/sendSubscribe")
+        
+        # Agent card cache, revalidated with If-None-Match after AGENT_CARD_TTL
+        self._card: Optional[Dict] = None
+        self._card_ts: float = 0
+        self._card_etag: Optional[str] = None
+        self._card_path = AGENT_CARD_CACHE_DIR / f"{urlparse(self.agent_url).netloc.replace(':', '_')}.json"
+        
+    @staticmethod
+    def _envelope(method: bytes) -> bytes:
+        """Build a task request template with holes for request id, task id, session id and message"""
+        return (
+            b'{"jsonrpc":"2.0","id":"%s","method":"' + method + b'",'
+            b'"params":{"id":"%s","sessionId":%s,'
+            b'"message":{"role":"user","parts":[{"type":"text","text":%s}]},'
+            b'"acceptedOutputModes":["text"]}}'
+        )
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Pooled HTTP client shared by every call to this agent"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(
+                    http2=True,
+                    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+                    retries=2
+                ),
+                headers={"Content-Type": "application/json"},
+                timeout=httpx.Timeout(10.0, read=None)
+            )
+        return self._client
+        
+    async def discover_agent(self) -> Dict:
         """Discover agent capabilities by fetching agent card"""
+        if self._card and time.monotonic() - self._card_ts < AGENT_CARD_TTL:
+            return self._card
+        if self._card is None:
+            self._load_card()
+        
+        headers = {"If-None-Match": self._card_etag} if self._card and self._card_etag else {}
         try:
-            response = requests.get(f"{self.agent_url}/.well-known/agent.json")
+            response = await self.client.get(f"{self.agent_url}/.well-known/agent.json", headers=headers)
+            if response.status_code == 304:
+                self._card_ts = time.monotonic()
+                return self._card
             response.raise_for_status()
-            return response.json()
+            self._card = orjson.loads(response.content)
+            self._card_ts = time.monotonic()
+            self._card_etag = response.headers.get("ETag")
+            self._save_card()
+            return self._card
         except Exception as e:
-            print(f"Error discovering agent: {e}")
+            logger.error("Error discovering agent: %s", e)
             return {}
     
-    def send_task(self, message: str) -> Dict:
+    def _load_card(self) -> None:
+        """Load the agent card persisted by a previous process, if any"""
+        try:
+            cached = orjson.loads(self._card_path.read_bytes())
+        except (OSError, orjson.JSONDecodeError):
+            return
+        if cached.get("url") == self.agent_url:
+            self._card = cached.get("card")
+            self._card_etag = cached.get("etag")
+    
+    def _save_card(self) -> None:
+        """Persist the agent card for reuse across processes"""
+        try:
+            self._card_path.parent.mkdir(parents=True, exist_ok=True)
+            self._card_path.write_bytes(orjson.dumps({
+                "url": self.agent_url,
+                "etag": self._card_etag,
+                "card": self._card
+            }))
+        except OSError as e:
+            logger.debug("Could not persist agent card: %s", e)
+    
+    async def send_task(self, message: str, session_id: Optional[str] = None) -> str:
         """Send a task to the agent
         
         Args:
             message: User message to send
+            session_id: A2A session of the conversation; defaults to the client's own
             
         Returns:
-            Task response from the agent
+            Text of the agent's response
+            
+        Raises:
+            A2AError: If the request failed or the response has no text
         """
-        self.task_id = f"task-{os.urandom(8).hex()}"
-        
-        payload = {
-            "jsonrpc": "2.0",
-            "id": self.task_id,
-            "method": "tasks/send",
-            "params": {
-                "id": self.task_id,
-                "sessionId": self.session_id,
-                "message": {
-                    "role": "user",
-                    "parts": [{"type": "text", "text": message}]
-                },
-                "acceptedOutputModes": ["text"]
-            }
-        }
+        task_id = f"task-{self._task_prefix}-{next(self._task_counter):x}".encode()
+        session = orjson.dumps(session_id or self.session_id)
+        
+        payload = self._send_tpl % (task_id, task_id, session, orjson.dumps(message))
         
         try:
-            response = requests.post(
+            response = await self.client.post(
                 f"{self.agent_url}/",
-                json=payload,
-                headers={"Content-Type": "application/json"}
+                content=payload
             )
-            print(response.json())
+            data = orjson.loads(response.content)
+            logger.debug("Task response: %s", data)
             response.raise_for_status()
-            return response.json()['result']['status']['message']['parts'][0]['text']
+            return data['result']['status']['message']['parts'][0]['text']
         except Exception as e:
-            print(f"Error sending task: {e}")
-            return {}
+            logger.error("Error sending task: %s", e)
+            raise A2AError(f"Error sending task to {self.agent_url}: {e}") from e
     
-    def send_task_subscribe(self, message: str) -> Dict:
+    async def send_task_subscribe(self, message: str, session_id: Optional[str] = None) -> Optional["EventStream"]:
         """Send a task and subscribe to updates
         
         Args:
             message: User message to send
+            session_id: A2A session of the conversation; defaults to the client's own
             
         Returns:
-            Generator that yields response chunks
+            Event stream of the task, or None if it could not be opened
         """
-        self.task_id = f"task-{os.urandom(8).hex()}"
-        
-        # First send the task
-        payload = {
-            "jsonrpc": "2.0",
-            "id": f"{self.task_id}-send",
-            "method": "tasks/sendSubscribe",
-            "params": {
-                "id": self.task_id,
-                "sessionId": self.session_id,
-                "message": {
-                    "role": "user",
-                    "parts": [{"type": "text", "text": message}]
-                },
-                "acceptedOutputModes": ["text"]
-            }
-        }
+        task_id = f"task-{self._task_prefix}-{next(self._task_counter):x}".encode()
+        session = orjson.dumps(session_id or self.session_id)
+        
+        payload = self._subscribe_tpl % (task_id + b"-send", task_id, session, orjson.dumps(message))
+        
+        request = self.client.build_request(
+            "POST",
+            f"{self.agent_url}/",
+            content=payload,
+            headers={"Accept": "text/event-stream"}
+        )
+        try:
+            response = await self.client.send(request, stream=True)
+        except Exception as e:
+            logger.error("Error sending task with subscription: %s", e)
+            return None
         
         try:
-            response = requests.post(
-                f"{self.agent_url}/",
-                json=payload,
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "text/event-stream"
-                },
-                stream=True
-            )
             response.raise_for_status()
-            
-            return sseclient.SSEClient(response)
         except Exception as e:
-            print(f"Error sending task with subscription: {e}")
+            await response.aclose()
+            logger.error("Error sending task with subscription: %s", e)
             return None
+        
+        return EventStream(response)
+
+
+class EventStream:
+    """Server-sent event stream of an A2A task"""
+    
+    def __init__(self, response: httpx.Response):
+        """Initialize the event stream
+        
+        Args:
+            response: Streaming response opened by send_task_subscribe
+        """
+        self.response = response
+        # The response body can only be read once, so every consumer shares one generator
+        self._iter: Optional[AsyncIterator[Tuple[str, Any]]] = None
+        self._pending: List[Tuple[str, Any]] = []
+    
+    def __aiter__(self) -> "EventStream":
+        return self
+    
+    async def __anext__(self) -> Tuple[str, Any]:
+        if self._pending:
+            return self._pending.pop()
+        if self._iter is None:
+            self._iter = self._events()
+        return await self._iter.__anext__()
+    
+    async def peek(self) -> Tuple[str, Any]:
+        """Wait for the next event without consuming it"""
+        event = await self.__anext__()
+        self._pending.append(event)
+        return event
+    
+    async def _events(self) -> AsyncIterator[Tuple[str, Any]]:
+        """Yield (event_type, decoded data) for each SSE event and close the response when done"""
+        try:
+            buf = bytearray()
+            pending_cr = False
+            async for chunk in self.response.aiter_bytes(chunk_size=8192):
+                # Normalize CRLF and CR line endings, including a CRLF split across chunks
+                if pending_cr and chunk.startswith(b"\n"):
+                    chunk = chunk[1:]
+                pending_cr = chunk.endswith(b"\r")
+                if b"\r" in chunk:
+                    chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+                buf += chunk
+                
+                # Parse every complete event, then drop them from the buffer in one go
+                events = []
+                start = 0
+                with memoryview(buf) as view:
+                    end = buf.find(b"\n\n", start)
+                    while end != -1:
+                        event = _parse_event(buf, view, start, end)
+                        if event is not None:
+                            events.append(event)
+                        start = end + 2
+                        end = buf.find(b"\n\n", start)
+                if start:
+                    del buf[:start]
+                for event in events:
+                    yield event
+            
+            if buf.strip():
+                with memoryview(buf) as view:
+                    event = _parse_event(buf, view, 0, len(buf))
+                if event is not None:
+                    yield event
+        finally:
+            await self.response.aclose()
+    
+    async def aclose(self) -> None:
+        """Close the underlying response, whether or not it was iterated"""
+        if self._iter is not None:
+            await self._iter.aclose()
+        await self.response.aclose()
+    
+    @property
+    def cacheable(self) -> bool:
+        """Whether the agent marked its response as deterministic with a 'cache: true' header"""
+        return self.response.headers.get("cache", "false").lower() == "true"
+
+
+def _parse_event(buf: bytearray, view: memoryview, start: int, end: int) -> Optional[Tuple[str, Any]]:
+    """Parse one SSE event from buf[start:end] and decode its data as JSON
+    
+    Returns:
+        (event_type, data) where data is None for an empty payload,
+        or None if the event carries no data field
+    """
+    event_type = "message"
+    data = []
+    pos = start
+    while pos < end:
+        eol = buf.find(b"\n", pos, end)
+        if eol == -1:
+            eol = end
+        colon = buf.find(b":", pos, eol)
+        if colon == -1:
+            field_end = value_start = eol
+        else:
+            field_end, value_start = colon, colon + 1
+            if value_start < eol and buf[value_start] == 0x20:
+                value_start += 1
+        # Comments (empty field), id and retry are not used by A2A
+        field = view[pos:field_end]
+        if field == b"data":
+            data.append(view[value_start:eol])
+        elif field == b"event":
+            event_type = bytes(view[value_start:eol]).decode()
+        pos = eol + 1
+    
+    if not data:
+        return None
+    payload = data[0] if len(data) == 1 else b"\n".join(data)
+    return event_type, orjson.loads(payload) if len(payload) else None
+
+
+async def _discard_prefetch(task: "asyncio.Task[Optional[EventStream]]") -> None:
+    """Cancel a speculative stream request, or close its stream if it already opened"""
+    if not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return
+    if not task.cancelled() and task.exception() is None and task.result() is not None:
+        await task.result().aclose()
+
+
+async def _first_event(stream_task: "asyncio.Task[Optional[EventStream]]") -> Optional[EventStream]:
+    """Wait until a stream has produced its first event, or None if it errored"""
+    try:
+        stream = await stream_task
+    except Exception as e:
+        logger.error("Error sending task with subscription: %s", e)
+        return None
+    if stream is None:
+        return None
+    try:
+        _, data = await stream.peek()
+        if data is None or data.get("error") is None:
+            return stream
+    except Exception as e:
+        logger.error("Error reading first event: %s", e)
+    except BaseException:
+        await stream.aclose()
+        raise
+    await stream.aclose()
+    return None
+
 
 class DispatcherAgent:
     """Dispatcher agent that routes queries to appropriate specialized agents"""
@@ -127,6 +530,19 @@ class DispatcherAgent:
         self.sql_agent = A2AClient(os.environ.get("SQL_AGENT_URL"))
         self.rag_agent = A2AClient(os.environ.get("RAG_AGENT_URL"))
         
+        # Routing decisions are memoized by normalized query
+        self._route_cache = RouteCache(
+            semantic=os.environ.get("ROUTE_CACHE_SEMANTIC", "false").lower() == "true"
+        )
+        
+        # Complete specialized agent responses are cached in redis when REDIS_URL is set
+        # and the agent opts in per response
+        self._response_cache = ResponseCache(os.environ.get("REDIS_URL"))
+        
+        # Open both specialized agent streams while the router decides;
+        # doubles backend load, so only enable when backends have headroom
+        self.speculative_routing = os.environ.get("SPECULATIVE_ROUTING", "false").lower() == "true"
+        
         # Create AG2 agent for decision making
         self.agent = ConversableAgent(
             name="dispatcher",
@@ -140,67 +556,227 @@ class DispatcherAgent:
             llm_config=llm_config
         )
     
-    def decide_agent(self, query: str) -> str:
+    async def decide_agent(self, query: str) -> str:
         """Decide which agent should handle the query
         
         Args:
             query: User query
             
         Returns:
-            Agent type: 'sql', 'nothing', or 'rag'
+            Agent type: 'sql', 'nothing', 'rag', or 'both' when either could answer
         """
+        agent_type = _classify(query)
+        if agent_type is not None:
+            return agent_type
+        
+        key = _normalize(query)
+        cached = self._route_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        # The embedding is computed once and reused when the decision is stored
+        embedding = await self._route_cache.embed(key)
+        if embedding is not None:
+            cached = self._route_cache.get(key, embedding)
+            if cached is not None:
+                return cached
+        
         # Use the AG2 agent to make a decision
-        response = self.agent.generate_reply(
-            messages=[{"role": "user", "content": f"Decide if this query should be handled by the SQL writer agent or the RAG agent: {query}. You must answer only one word either 'sql', 'nothing', or 'rag' only."}]
+        response = await self._generate_reply(
+            [{"role": "user", "content": f"Decide if this query should be handled by the SQL writer agent or the RAG agent: {query}. You must answer only one word either 'sql', 'nothing', 'rag', or 'both' (only if it is unclear whether the SQL writer agent or the RAG agent should answer) only."}]
         )
         
         if response['content'] and isinstance(response['content'], str):
-            return response['content']
+            agent_type = response['content'].strip().strip(".'\"").lower()
+            if agent_type in AGENT_TYPES:
+                self._route_cache.put(key, agent_type, embedding)
+                return agent_type
         
         return "nothing"
         
-    def process_query_stream(self, query: str, agent_type: str) -> Union[sseclient.SSEClient, Dict, str]:
+    async def _generate_reply(self, messages: List[Dict[str, str]]) -> Any:
+        """Run the AG2 agent's blocking generate_reply on the shared thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, lambda: self.agent.generate_reply(messages=messages))
+        
+    async def cache_response(self, agent_type: str, query: str, content: str) -> None:
+        """Cache the complete response of a specialized agent
+        
+        Args:
+            agent_type: Agent that produced the response
+            query: User query
+            content: Final response text
+        """
+        if agent_type in ("sql", "rag"):
+            await self._response_cache.set(agent_type, query, content)
+        
+    async def route_query_stream(self, query: str, session_id: Optional[str] = None) -> Tuple[str, Union[EventStream, str]]:
+        """Decide which agent should handle the query and stream its response
+        
+        With speculative routing enabled, both specialized agents are asked to
+        stream while the router LLM decides, and the stream not chosen is closed.
+        Ambiguous queries are sent to both agents and the first one to produce
+        a non-error event wins.
+        
+        Args:
+            query: User query
+            session_id: A2A session of the user's conversation
+            
+        Returns:
+            Agent type that answered and the result of process_query_stream for it
+        """
+        agent_type = _classify(query) or self._route_cache.get(_normalize(query))
+        prefetch: Dict[str, "asyncio.Task[Optional[EventStream]]"] = {}
+        if agent_type is None and self.speculative_routing:
+            prefetch = self._subscribe_all(query, session_id)
+            try:
+                agent_type = await self.decide_agent(query)
+            finally:
+                if agent_type != "both":
+                    chosen = prefetch.pop(agent_type, None) if agent_type else None
+                    for task in prefetch.values():
+                        await _discard_prefetch(task)
+                    prefetch = {agent_type: chosen} if chosen else {}
+        elif agent_type is None:
+            agent_type = await self.decide_agent(query)
+        
+        candidates = ("sql", "rag") if agent_type == "both" else (agent_type,)
+        for candidate in candidates:
+            if candidate not in ("sql", "rag"):
+                continue
+            cached = await self._response_cache.get(candidate, query)
+            if cached is not None:
+                print(f"Serving cached {candidate.upper()} agent response")
+                for task in prefetch.values():
+                    await _discard_prefetch(task)
+                return candidate, cached
+        
+        if agent_type == "both":
+            return await self._fan_out(query, prefetch or self._subscribe_all(query, session_id), session_id)
+        
+        if agent_type not in prefetch:
+            return agent_type, await self.process_query_stream(query, agent_type, session_id)
+        
+        print(f"Routing to {agent_type.upper()} agent (speculative stream)")
+        try:
+            stream_client = await prefetch[agent_type]
+        except Exception as e:
+            print(f"Error in streaming, falling back to regular request: {e}")
+            stream_client = None
+        if stream_client is None:
+            print("Streaming not available, falling back to regular request")
+            return agent_type, await self._fallback(agent_type, query, session_id)
+        return agent_type, stream_client
+    
+    def _client_for(self, agent_type: str) -> A2AClient:
+        return self.sql_agent if agent_type == "sql" else self.rag_agent
+    
+    def _subscribe_all(self, query: str, session_id: Optional[str]) -> Dict[str, "asyncio.Task[Optional[EventStream]]"]:
+        """Start streaming the query from both specialized agents"""
+        return {
+            "sql": asyncio.create_task(self.sql_agent.send_task_subscribe(query, session_id)),
+            "rag": asyncio.create_task(self.rag_agent.send_task_subscribe(query, session_id)),
+        }
+    
+    async def _fan_out(self, query: str, streams: Dict[str, "asyncio.Task[Optional[EventStream]]"], session_id: Optional[str]) -> Tuple[str, Union[EventStream, str]]:
+        """Return the first stream to produce a non-error event and close the others
+        
+        Args:
+            query: User query
+            streams: Pending send_task_subscribe calls keyed by agent type
+            session_id: A2A session of the user's conversation
+            
+        Returns:
+            Agent type of the winning stream and the stream itself, or of the
+            first agent to answer the non-streaming fallback
+            
+        Raises:
+            A2AError: If no agent could answer
+        """
+        print("Ambiguous query, streaming from SQL writer and RAG agents")
+        pending = {asyncio.create_task(_first_event(task)): agent_type for agent_type, task in streams.items()}
+        failed = []
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    agent_type = pending.pop(task)
+                    stream_client = task.result()
+                    if stream_client is None:
+                        failed.append(agent_type)
+                        continue
+                    if winner is None:
+                        winner = agent_type, stream_client
+                    else:
+                        await stream_client.aclose()
+                if winner is not None:
+                    return winner
+        finally:
+            for task in pending:
+                await _discard_prefetch(task)
+        
+        # Try every agent without streaming, starting with the stream that failed last
+        print("Streaming not available, falling back to regular request")
+        error = A2AError("No specialized agent could answer")
+        for agent_type in reversed(failed):
+            try:
+                return agent_type, await self._fallback(agent_type, query, session_id)
+            except A2AError as e:
+                error = e
+        raise error
+        
+    async def process_query_stream(self, query: str, agent_type: str, session_id: Optional[str] = None) -> Union[EventStream, str]:
         """Process a user query and stream the response
         
         Args:
             query: User query
+            agent_type: Agent chosen by decide_agent
+            session_id: A2A session of the user's conversation
             
         Returns:
-            SSE client for streaming updates, response dict, or string response
+            Event stream for streaming updates or string response
         """
+        if agent_type not in ("sql", "rag"):
+            print("Handling query directly")
+            return await self._answer_directly(query)
+        
         try:
-            if agent_type == "sql":
-                print("Routing to SQL writer agent (streaming)")
-                stream_client = self.sql_agent.send_task_subscribe(query)
-                if stream_client is None:
-                    print("Streaming not available, falling back to regular request")
-                    return self.sql_agent.send_task(query)
-                return stream_client
-            elif agent_type == "rag":
-                print("Routing to RAG agent (streaming)")
-                stream_client = self.rag_agent.send_task_subscribe(query)
-                if stream_client is None:
-                    print("Streaming not available, falling back to regular request")
-                    return self.rag_agent.send_task(query)
-                return stream_client
-            else:
-                print("Handling query directly")
-                # Generate response using the dispatcher's own LLM
-                response = self.agent.generate_reply(
-                    messages=[{"role": "user", "content": query}]
-                )
-                return response['content'] if response['content'] else "I couldn't process your query."
+            return await self._try_stream(agent_type, query, session_id)
+        except A2AError:
+            # The non-streaming fallback already failed; do not send the task again
+            raise
         except Exception as e:
             print(f"Error in streaming, falling back to regular request: {e}")
-            if agent_type == "sql":
-                return self.sql_agent.send_task(query)
-            elif agent_type == "rag":
-                return self.rag_agent.send_task(query)
-            else:
-                # Handle directly in case of error
-                response = self.agent.generate_reply(
-                    messages=[{"role": "user", "content": query}]
-                )
-                return response['content'] if response['content'] else "I couldn't process your query."
-
-                
\ No newline at end of file
+            return await self._fallback(agent_type, query, session_id)
+    
+    async def _try_stream(self, agent_type: str, query: str, session_id: Optional[str]) -> Union[EventStream, str]:
+        """Stream the query from a specialized agent, falling back if streaming is unavailable"""
+        print(f"Routing to {AGENT_NAMES[agent_type]} (streaming)")
+        stream_client = await self._client_for(agent_type).send_task_subscribe(query, session_id)
+        if stream_client is None:
+            print("Streaming not available, falling back to regular request")
+            return await self._fallback(agent_type, query, session_id)
+        return stream_client
+    
+    async def _fallback(self, agent_type: str, query: str, session_id: Optional[str]) -> str:
+        """Answer from a specialized agent without streaming, preferring a cached response
+        
+        Raises:
+            A2AError: If the agent could not answer
+        """
+        cached = await self._response_cache.get(agent_type, query)
+        if cached is not None:
+            return cached
+        return await self._client_for(agent_type).send_task(query, session_id)
+    
+    async def _answer_directly(self, query: str) -> str:
+        """Answer with the dispatcher's own LLM; a failed call is not retried"""
+        try:
+            response = await self._generate_reply([{"role": "user", "content": query}])
+        except Exception as e:
+            logger.error("Error answering directly: %s", e)
+            return "I couldn't process your query."
+        return response['content'] if response['content'] else "I couldn't process your query."
+
+
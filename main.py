@@ -1,15 +1,32 @@
 import streamlit as st
+import asyncio
 import os
-import json
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
-from agent import DispatcherAgent
+from agent import A2AError, DispatcherAgent, EventStream
 from autogen import LLMConfig
 
+# Use libuv's event loop for the agent I/O loop below (not available on Windows)
+try:
+    import uvloop
+    new_event_loop = uvloop.new_event_loop
+except ImportError:
+    new_event_loop = asyncio.new_event_loop
+
 # Load environment variables
 load_dotenv()
 
-# Initialize the dispatcher agent
-def initialize_agent():
+# Streamed text is re-rendered at most every FLUSH_INTERVAL seconds,
+# or sooner once it has grown by FLUSH_CHARS characters
+FLUSH_INTERVAL = 0.05
+FLUSH_CHARS = 64
+
+# Initialize the dispatcher agent once per server process and share it across sessions;
+# each browser session keeps its own A2A session id (see respond)
+@st.cache_resource
+def get_cached_agent():
     """Initialize the dispatcher agent with LLM config"""
     llm_config = LLMConfig(
         api_type="groq",
@@ -19,6 +36,113 @@ def initialize_agent():
     
     return DispatcherAgent(llm_config=llm_config)
 
+# One event loop per server process, running in a daemon thread, so pooled
+# connections to the specialized agents survive across chat turns
+@st.cache_resource
+def get_event_loop():
+    """Start the long-lived event loop that runs all agent I/O"""
+    loop = new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-io", daemon=True).start()
+    return loop
+
+def run(coro):
+    """Run a coroutine on the agent I/O loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+async def next_event(client: EventStream):
+    """Return the next event of a stream, or None once it is exhausted"""
+    try:
+        return await client.__anext__()
+    except StopAsyncIteration:
+        return None
+
+def respond(agent: DispatcherAgent, prompt: str, session_id: str) -> dict:
+    """Route the prompt and render the streamed answer
+    
+    Streamlit calls must stay on the script thread, so only the agent I/O
+    is submitted to the event loop.
+    
+    Args:
+        agent: Dispatcher agent shared by all sessions
+        prompt: User prompt
+        session_id: A2A session of this browser session's conversation
+        
+    Returns:
+        Final response with status and content
+    """
+    final_response = {"status": "incomplete", "content": ""}
+    
+    # Determine which agent to use and process query with streaming
+    try:
+        agent_type, client = run(agent.route_query_stream(prompt, session_id))
+    except A2AError as e:
+        final_response["status"] = "error"
+        final_response["error"] = str(e)
+        final_response["content"] = "I couldn't process your query."
+        st.write(final_response["content"])
+        return final_response
+    if isinstance(client, str):
+        st.write(f"Routing to {agent_type.upper()} agent...")
+        message_placeholder = st.empty()  # Initialize the placeholder here
+        message_placeholder.write(client)
+        # stop here
+        final_response["status"] = "complete"
+        final_response["content"] = client
+        return final_response
+    
+    content = ""
+    rendered_len = 0
+    last_flush = time.monotonic()
+    # Any st.* call may raise Streamlit's stop/rerun exception, so the stream
+    # is closed in finally from the moment it is open
+    try:
+        st.write(f"Routing to {agent_type.upper()} agent...")
+        message_placeholder = st.empty()  # Initialize the placeholder here
+        render = message_placeholder.markdown
+        
+        while (event := run(next_event(client))) is not None:
+            event_type, data = event
+            if not data:
+                continue
+                
+            result = data.get("result")
+            if result is not None:
+                # Handle task status update; events without a message carry no text
+                try:
+                    parts = result["status"]["message"]["parts"]
+                except (KeyError, TypeError):
+                    parts = ()
+                for part in parts:
+                    if part.get("type") == "text":
+                        content = part["text"]
+                
+                # Check if this is the final message
+                if result.get("final"):
+                    final_response["status"] = "complete"
+                    break
+                
+                now = time.monotonic()
+                if now - last_flush >= FLUSH_INTERVAL or abs(len(content) - rendered_len) >= FLUSH_CHARS:
+                    render(content)
+                    rendered_len = len(content)
+                    last_flush = now
+            
+            # Handle errors
+            error = data.get("error")
+            if error is not None:
+                final_response["status"] = "error"
+                final_response["error"] = error
+                break
+    finally:
+        run(client.aclose())
+    final_response["content"] = content
+    render(content)
+    
+    if final_response["status"] == "complete" and client.cacheable:
+        run(agent.cache_response(agent_type, prompt, content))
+    
+    return final_response
+
 # Streamlit UI
 st.set_page_config(page_title="A2A Dispatcher Agent", layout="wide")
 
@@ -27,7 +151,11 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 
 if "agent" not in st.session_state:
-    st.session_state.agent = initialize_agent()
+    st.session_state.agent = get_cached_agent()
+
+# The specialized agents group conversation context by A2A session
+if "session_id" not in st.session_state:
+    st.session_state.session_id = str(uuid.uuid4())
 
 # App header
 st.title("A2A Dispatcher Agent")
@@ -55,50 +183,7 @@ if prompt := st.chat_input("What would you like to ask?"):
     # Get agent response
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
-            # Determine which agent to use
-            agent_type = st.session_state.agent.decide_agent(prompt)
-            st.write(f"Routing to {agent_type.upper()} agent...")
-            
-            # Process query with streaming
-            client = st.session_state.agent.process_query_stream(prompt, agent_type)
-            full_response = ""
-            message_placeholder = st.empty()  # Initialize the placeholder here
-
-            final_response = {"status": "incomplete", "content": ""}
-            if isinstance(client, str):
-                message_placeholder.write(client)
-                # stop here
-                final_response["status"] = "complete"
-                final_response["content"] = client
-            else:
-                for event in client.events():
-                    if not event.data:
-                        continue
-                        
-                    data = json.loads(event.data)
-                    if "result" in data:
-                        result = data["result"]
-                        
-                        # Handle task status update
-                        if "status" in result:
-                            status = result["status"]
-                            if "message" in status and status["message"]:
-                                message_parts = status["message"]["parts"]
-                                for part in message_parts:
-                                    if part["type"] == "text":
-                                        final_response["content"] = part["text"]
-                                        message_placeholder.write(final_response["content"])
-                        
-                        # Check if this is the final message
-                        if "final" in result and result["final"]:
-                            final_response["status"] = "complete"
-                            break
-                    
-                    # Handle errors
-                    if "error" in data:
-                        final_response["status"] = "error"
-                        final_response["error"] = data["error"]
-                        break
+            final_response = respond(st.session_state.agent, prompt, st.session_state.session_id)
     
     # Add assistant response to chat history
     st.session_state.messages.append({"role": "assistant", "content": final_response["content"]})